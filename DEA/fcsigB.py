@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #
 # This script takes a database file (SQLite) obtained from the PIQMIe service to perform differential
 # protein expression analysis using fold-changes (normalized SILAC ratios) and peak-intensity based
@@ -13,10 +13,12 @@
 import os
 import sys
 import argparse as argp
+import csv
+import io
 import math
 import numpy as np
 import sqlite3 as sqlt
-import collections as cls
+import pathlib
 
 def main():
    # parse command-line args
@@ -74,18 +76,18 @@ def main():
    if outfile is None:
       outfile = os.path.join(os.path.dirname(dbfile), '%s_fcsigB_fc_%.2f_p_%.2f.tab' % (dts, fc_cutoff, sigB_cutoff)) # fullpath of the outfile
 
-   print """
+   print("""
 dbfile = %s
 outfile = %s
 dataset = %s
 FC cutoff = %.2f
 P-value cutoff = %.2f
-   """ % (dbfile, outfile, dts, fc_cutoff, sigB_cutoff)
+   """ % (dbfile, outfile, dts, fc_cutoff, sigB_cutoff))
 
-   # sqlite3 user-defined function (UDF)
-   def log(value, base):
+   # sqlite3 user-defined function (UDF), fallback if SQLite is built without math functions
+   def log2(value):
       try:
-         return math.log(value) / math.log(base)
+         return math.log2(value)
       except:
          return None
 
@@ -93,13 +95,13 @@ P-value cutoff = %.2f
    # Note: filter by fold-change only if sigB cutoff set to 1 (default)
 
    sigB_filter = """
-      AND {dts}_L0_M0_H1_sig_ratio_HL < {cutoff}
-      AND {dts}_L0_M0_H1_sig_ratio_HM < {cutoff}
-      AND {dts}_L1_M1_H0_sig_ratio_LH < {cutoff}
-      AND {dts}_L1_M1_H0_sig_ratio_MH < {cutoff}
-      AND {dts}_L0_M0_H1_sig_ratio_LM >= {cutoff}
-      AND {dts}_L1_M1_H0_sig_ratio_LM >= {cutoff}
-   """.format(dts = dts, cutoff = sigB_cutoff)
+      AND {dts}_L0_M0_H1_sig_ratio_HL < :sigB
+      AND {dts}_L0_M0_H1_sig_ratio_HM < :sigB
+      AND {dts}_L1_M1_H0_sig_ratio_LH < :sigB
+      AND {dts}_L1_M1_H0_sig_ratio_MH < :sigB
+      AND {dts}_L0_M0_H1_sig_ratio_LM >= :sigB
+      AND {dts}_L1_M1_H0_sig_ratio_LM >= :sigB
+   """.format(dts = dts)
 
    treat_gt_ctrl_ratio_filter = """
       AND MIN(MAX({dts}_L0_M0_H1_norm_ratio_HL, {dts}_L0_M0_H1_norm_ratio_LH),
@@ -112,22 +114,39 @@ P-value cutoff = %.2f
 
    extra_filter = sigB_filter if sigB_cutoff != 1 else treat_gt_ctrl_ratio_filter
 
+   # lowest fold-changes of the treatments (up- or down-regulated)
+   fc_up = 'MIN({dts}_L0_M0_H1_norm_ratio_HL, {dts}_L0_M0_H1_norm_ratio_HM, {dts}_L1_M1_H0_norm_ratio_LH, {dts}_L1_M1_H0_norm_ratio_MH)'.format(dts = dts)
+   fc_down = 'MIN({dts}_L0_M0_H1_norm_ratio_LH, {dts}_L0_M0_H1_norm_ratio_MH, {dts}_L1_M1_H0_norm_ratio_HL, {dts}_L1_M1_H0_norm_ratio_HM)'.format(dts = dts)
+
+   # gene names per protein group: stored in the db by mzscore.py -n, otherwise joined inline
+   sql_genes_stored = dict(
+      genes    = 'G.genes',
+      tables   = 'VVV_PGROUP_QUANT A, GRP_GENES G',
+      join     = 'A.grp_id = G.grp_id',
+      group_by = '')
+
+   sql_genes_inline = dict(
+      genes    = "IFNULL(GROUP_CONCAT(DISTINCT C.gene), '-')",
+      tables   = 'VVV_PGROUP_QUANT A, PROT2GRP B, V_PROTEIN C',
+      join     = 'A.grp_id = B.grp_id AND B.prot_acc = C.acc',
+      group_by = 'GROUP BY A.grp_id')
+
    sql_sel_pgrps = """
       SELECT
-         A.grp_id grp_id,
-         IFNULL(GROUP_CONCAT(DISTINCT gene), '-') genes,
+         CAST(A.grp_id AS TEXT) grp_id,
+         {genes} AS genes,
          {dts}_L0_M0_H1_norm_ratio_HL AS ratio_H1L0, -- norm. ratio ON/OFF  (treat1)
          {dts}_L1_M1_H0_norm_ratio_LH AS ratio_L1H0, -- norm. ratio ON/OFF  (treat2)
          {dts}_L0_M0_H1_norm_ratio_HM AS ratio_H1M0, -- norm. ratio ON/OFF  (treat3)
          {dts}_L1_M1_H0_norm_ratio_MH AS ratio_M1H0, -- norm. ratio ON/OFF  (treat4)
          {dts}_L0_M0_H1_norm_ratio_LM AS ratio_L0M0, -- norm. ratio OFF/OFF (ctrl1)
          {dts}_L1_M1_H0_norm_ratio_LM AS ratio_L1M1, -- norm. ratio ON/ON   (ctrl2)
-         LOG({dts}_L0_M0_H1_norm_ratio_HL, 2) AS log2ratio_H1L0, -- log2 ratio ON/OFF  (treat1)
-         LOG({dts}_L1_M1_H0_norm_ratio_LH, 2) AS log2ratio_L1H0, -- log2 ratio ON/OFF  (treat2)
-         LOG({dts}_L0_M0_H1_norm_ratio_HM, 2) AS log2ratio_H1M0, -- log2 ratio ON/OFF  (treat3)
-         LOG({dts}_L1_M1_H0_norm_ratio_MH, 2) AS log2ratio_M1H0, -- log2 ratio ON/OFF  (treat4)
-         LOG({dts}_L0_M0_H1_norm_ratio_LM, 2) AS log2ratio_L0M0, -- log2 ratio OFF/OFF (ctrl1)
-         LOG({dts}_L1_M1_H0_norm_ratio_LM, 2) AS log2ratio_L1M1, -- log2 ratio ON/ON   (ctrl2)
+         LOG2({dts}_L0_M0_H1_norm_ratio_HL) AS log2ratio_H1L0, -- log2 ratio ON/OFF  (treat1)
+         LOG2({dts}_L1_M1_H0_norm_ratio_LH) AS log2ratio_L1H0, -- log2 ratio ON/OFF  (treat2)
+         LOG2({dts}_L0_M0_H1_norm_ratio_HM) AS log2ratio_H1M0, -- log2 ratio ON/OFF  (treat3)
+         LOG2({dts}_L1_M1_H0_norm_ratio_MH) AS log2ratio_M1H0, -- log2 ratio ON/OFF  (treat4)
+         LOG2({dts}_L0_M0_H1_norm_ratio_LM) AS log2ratio_L0M0, -- log2 ratio OFF/OFF (ctrl1)
+         LOG2({dts}_L1_M1_H0_norm_ratio_LM) AS log2ratio_L1M1, -- log2 ratio ON/ON   (ctrl2)
          {dts}_L0_M0_H1_sig_ratio_HL AS pval_H1L0, -- sigB ON/OFF  (treat1)
          {dts}_L1_M1_H0_sig_ratio_LH AS pval_L1H0, -- sigB ON/OFF  (treat2)
          {dts}_L0_M0_H1_sig_ratio_HM AS pval_H1M0, -- sigB ON/OFF  (treat3)
@@ -135,45 +154,62 @@ P-value cutoff = %.2f
          {dts}_L0_M0_H1_sig_ratio_LM AS pval_L0M0, -- sigB OFF/OFF (ctrl1)
          {dts}_L1_M1_H0_sig_ratio_LM AS pval_L1M1  -- sigB ON/ON   (ctrl2)
      FROM
-        VVV_PGROUP_QUANT A, PROT2GRP B, V_PROTEIN C
+        {tables}
      WHERE
-        A.grp_id = B.grp_id
-        AND B.prot_acc = C.acc
-        AND (({dts}_L0_M0_H1_norm_ratio_HL > {cutoff}
-        AND {dts}_L0_M0_H1_norm_ratio_HM > {cutoff}
-        AND {dts}_L1_M1_H0_norm_ratio_LH > {cutoff}
-        AND {dts}_L1_M1_H0_norm_ratio_MH > {cutoff})
-        OR ({dts}_L0_M0_H1_norm_ratio_LH > {cutoff}
-        AND {dts}_L0_M0_H1_norm_ratio_MH > {cutoff}
-        AND {dts}_L1_M1_H0_norm_ratio_HL > {cutoff}
-        AND {dts}_L1_M1_H0_norm_ratio_HM > {cutoff})) {filter}
-     GROUP BY A.grp_id;
-   """.format(dts = dts, cutoff = fc_cutoff, filter = extra_filter)
-
-   # connect to db and write result set into file
-   with open(outfile, 'w') as fout:
-      with sqlt.connect(dbfile) as conn:
-         sep = '\t'                  # column separator
+        {join}
+        AND ({fc_up} > :fc OR {fc_down} > :fc) {filter}
+     {group_by}
+     ORDER BY A.grp_id;
+   """
+
+   # bind the cutoffs to the named placeholders (:fc, :sigB) so that the prepared statement is reused
+   params = dict(fc = fc_cutoff, sigB = sigB_cutoff)
+
+   # SQL statements to tune the (read-only) connection: 256MB page cache, in-memory temp tables
+   sql_pragmas = """
+      PRAGMA cache_size = -262144;
+      PRAGMA temp_store = MEMORY;
+      PRAGMA mmap_size = 268435456;
+   """
+
+   # connect to db (read-only) and write result set into file
+   dburi = pathlib.Path(dbfile).resolve().as_uri() + '?mode=ro' # honours a -wal file left by a writer
+   with io.open(outfile, 'w', buffering = 1 << 20, newline = '') as fout: # 1MB write buffer
+      with sqlt.connect(dburi, uri = True, cached_statements = 256) as conn:
+         writer = csv.writer(fout, delimiter = '\t', lineterminator = os.linesep)
          n_pgrps = 0                 # count differentially regulated proteins (groups)
-         conn.row_factory = sqlt.Row # enable column access by name: row['colnm']
-         conn.create_function('log', 2, log) # register log() UDF
+         conn.row_factory = sqlt.Row # rows indexed in C by position (row[0]) or name (row['colnm'])
+         try: # use the built-in log2() if SQLite is compiled with math functions
+            conn.execute('SELECT LOG2(1)')
+         except sqlt.OperationalError:
+            conn.create_function('log2', 1, log2, deterministic = True)
+         conn.executescript(sql_pragmas) # large page cache, in-memory temp tables
 
          try:
             cur = conn.cursor()
-            for drow in [ cls.OrderedDict(xi) for xi in cur.execute(sql_sel_pgrps) ]:
+            cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'GRP_GENES'")
+            sql_genes = sql_genes_stored if cur.fetchone()[0] else sql_genes_inline
+            cur.execute('PRAGMA query_only = 1')
+
+            cur.arraysize = 10000 # number of rows per fetchmany()
+            cur.execute(sql_sel_pgrps.format(dts = dts, fc_up = fc_up, fc_down = fc_down, filter = extra_filter, **sql_genes), params)
+            header = [ d[0] for d in cur.description ]
+
+            while True:
+               rows = cur.fetchmany()
+               if not rows:
+                  break
+
                # header line with column names
                if n_pgrps == 0:
-                  header = sep.join(drow.keys()) + os.linesep
-                  fout.write(header)
-
-               # rows with column values: grp_id, log2 ratios and sigB
-               row = drow.values()
-               grp_id = str(drow['grp_id'])
-               genes = str(drow['genes'])
-               scores = sep.join([ 'NA' if x is None else str(round(float(x), 4)) for x in row[2:] ])
-               srow = sep.join([grp_id, genes, scores]) + os.linesep
-               fout.write(srow)
-               n_pgrps += 1
+                  writer.writerow(header)
+
+               # rows with column values: grp_id, log2 ratios and sigB (NULL as NA)
+               vals = np.array([ row[2:] for row in rows ], dtype = np.float64) # NULL as NaN
+               svals = np.char.mod('%.4f', vals)
+               svals[np.isnan(vals)] = 'NA'
+               writer.writerows([ row[:2] + tuple(v) for (row, v) in zip(rows, svals.tolist()) ])
+               n_pgrps += len(rows)
 
             cur.close()
 
@@ -184,10 +220,10 @@ P-value cutoff = %.2f
 
    # remove empty outfile
    if os.path.getsize(outfile) == 0:
-      print 'Nothing to write onto outfile.'
+      print('Nothing to write onto outfile.')
       os.remove(outfile)
    else:
-      print 'Ndiff =', n_pgrps
+      print('Ndiff =', n_pgrps)
 
 if __name__ == '__main__':
    main()
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #
 # This script takes a database (SQLite) obtained from the PIQMIe service and populates
 # additional tables/views to facilitate differential protein expression analyses based
@@ -20,11 +20,14 @@
 import os
 import sys
 import argparse as argp
+import array
+import contextlib
+import csv
+import io
 import math
 import numpy as np
 import scipy.stats as st
 import sqlite3 as sqlt
-import collections as cls
 
 ratio_types = { # lookup to link column values to column names
     'RATIO H/L': 'raw_ratio_HL',
@@ -108,19 +111,19 @@ if cutoff < 0:
    parser.error('the absolute score cutoff must be a positive value')
 
 # print info into STDOUT
-print """
+print("""
 dbfile = %s
 outfile = %s
 dataset = %s
 re-score = %s
 score type = %s
 score cutoff = %.2f
-""" % (dbfile, outfile, dts, new_tabs, stype, cutoff)
+""" % (dbfile, outfile, dts, new_tabs, stype, cutoff))
 
 # sqlite3 user-defined functions (UDFs)
-def log(value, base):
+def log2(value): # fallback if SQLite is built without math functions
     try:
-        return math.log(value) / math.log(base)
+        return math.log2(value)
     except:
         return None
 
@@ -130,76 +133,121 @@ def sqrt(value):
     except:
         return None
 
-def pvalue(score): # convert Z- or M-score to two-tailed probability (P-value)
-    try:
-        return 2 * st.norm.cdf(-abs(score))
-    except:
-        return None
+def sql_statements(script): # split SQL script into single statements (';' in literals/comments kept)
+    stmts = []
+    stmt = ''
+    for line in script.splitlines(True):
+        stmt += line
+        if sqlt.complete_statement(stmt):
+            stmts.append(stmt.strip())
+            stmt = ''
+    if stmt.strip():
+        stmts.append(stmt.strip())
+    return stmts
 
 class Stdev: # sample standard deviation (aggregate function)
     def __init__(self):
-        self.vec = []
+        self.vec = array.array('d')
 
     def step(self, value):
-        self.vec.append(value)
+        if value is not None:
+            self.vec.append(value)
 
     def finalize(self):
-        return np.array(self.vec).std(ddof=1)
+        if len(self.vec) < 2:
+            return None
+        return np.frombuffer(self.vec, dtype=np.float64).std(ddof=1)
 
 class Median: # median (aggregate function)
     def __init__(self):
-        self.arr = []
+        self.vec = array.array('d')
 
     def step(self, value):
-        self.arr.append(value)
+        if value is not None:
+            self.vec.append(value)
 
     def finalize(self):
-        return np.median(np.array(self.arr))
+        if len(self.vec) == 0:
+            return None
+        return np.median(np.frombuffer(self.vec, dtype=np.float64))
 
 class Mad: # median absolute deviation (aggregate function)
     def __init__(self):
-        self.arr = []
+        self.vec = array.array('d')
 
     def step(self, value):
-        self.arr.append(value)
+        if value is not None:
+            self.vec.append(value)
 
     def finalize(self):
-        median = np.median(np.array(self.arr))
-        return np.median(np.abs(self.arr - median))
+        if len(self.vec) == 0:
+            return None
+        a = np.frombuffer(self.vec, dtype=np.float64) # writable view, updated in place
+        median = np.median(a, overwrite_input=True)
+        np.subtract(a, median, out=a)
+        np.abs(a, out=a)
+        return np.median(a, overwrite_input=True)
+
+# SQL statements to tune the connection: 256MB page cache, in-memory temp tables
+sql_pragmas = """
+PRAGMA cache_size = -262144;
+PRAGMA temp_store = MEMORY;
+PRAGMA mmap_size = 268435456;
+"""
+
+# SQL statements to speed up writes (-n only): fewer fsyncs, journal mode of the db left as is
+sql_pragmas_write = """
+PRAGMA synchronous = NORMAL;
+"""
 
 # SQL statements to populate tables/views
 sql_create_tables = """
 DROP VIEW IF EXISTS V_PGROUP_RATIO;
+DROP TABLE IF EXISTS RATIO_TYPE_MAP;
+CREATE TABLE RATIO_TYPE_MAP (
+    -- links SILAC ratio types (quant_type values) to column names
+    quant_type TEXT PRIMARY KEY,
+    ratio_type TEXT);
+INSERT INTO RATIO_TYPE_MAP VALUES %s;
+
 CREATE VIEW V_PGROUP_RATIO AS
 -- simplifies the selection of SILAC ratios/types
 SELECT
     A.grp_id,
     exp_name,
-    CAST(CASE %s
-    END AS TEXT) AS ratio_type,
+    M.ratio_type AS ratio_type,
     CAST(quant_value AS NUMERIC) AS ratio_value
 FROM
-    PGROUP_QUANT A, V_PGROUP B
+    PGROUP_QUANT A, V_PGROUP B, RATIO_TYPE_MAP M
 WHERE
     A.grp_id = B.grp_id
-    AND quant_type IN ('%s')
+    AND A.quant_type = M.quant_type
     AND quant_value;
 
 DROP TABLE IF EXISTS PGROUP_LOG2RATIO_STAT;
 CREATE TABLE PGROUP_LOG2RATIO_STAT AS
 -- stores descriptive statistics on SILAC protein ratios for each experiment
+WITH R AS ( -- log2-transform each ratio only once
+    SELECT
+        exp_name,
+        ratio_type,
+        LOG2(ratio_value) AS l2
+    FROM
+        V_PGROUP_RATIO
+    WHERE
+        ratio_value > 0)
 SELECT
     exp_name,
     ratio_type,
-    CAST(COUNT(ratio_value) AS INT) AS n,
-    CAST(MIN(LOG(ratio_value, 2)) AS NUMERIC) AS min,
-    CAST(MAX(LOG(ratio_value, 2)) AS NUMERIC) AS max,
-    CAST(AVG(LOG(ratio_value, 2)) AS NUMERIC) AS mean,
-    CAST(MEDIAN(LOG(ratio_value, 2)) AS NUMERIC) AS median,
-    CAST(STDEV(LOG(ratio_value, 2)) AS NUMERIC) AS sd,
-    CAST(MAD(LOG(ratio_value, 2)) AS NUMERIC) AS mad
+    CAST(COUNT(l2) AS INT) AS n,
+    CAST(MIN(l2) AS NUMERIC) AS min,
+    CAST(MAX(l2) AS NUMERIC) AS max,
+    CAST(AVG(l2) AS NUMERIC) AS mean,
+    CAST(MEDIAN(l2) AS NUMERIC) AS median,
+    CAST(STDEV(l2) AS NUMERIC) AS sd,
+    CAST(MAD(l2) AS NUMERIC) AS mad
 FROM
-    V_PGROUP_RATIO
+    R
 GROUP BY
     exp_name, ratio_type;
 CREATE INDEX idx_PGROUP_LOG2RATIO_STAT_exp_name_ratio_type ON PGROUP_LOG2RATIO_STAT(exp_name, ratio_type);
@@ -221,129 +269,205 @@ FROM
     PGROUP_LOG2RATIO_STAT;
 
 DROP TABLE IF EXISTS PGROUP_MZSCORE;
-CREATE TABLE PGROUP_MZSCORE AS
--- stores (modified) Z-score transformed SILAC protein raw/norm ratios
+CREATE TABLE PGROUP_MZSCORE (
+    -- stores (modified) Z-score transformed SILAC protein raw/norm ratios
+    grp_id INT,
+    exp_name TEXT,
+    ratio_type TEXT,
+    z_score NUMERIC,
+    m_score NUMERIC);
+""" % ', '.join([ "('%s', '%s')" % (k, v) for (k, v) in ratio_types.items() ])
+
+# SQL statements to store gene names per protein group (TEMP for dbs scored by an older version)
+sql_create_grp_genes = """
+DROP TABLE IF EXISTS GRP_GENES;
+CREATE %s TABLE GRP_GENES AS
+-- stores gene names for each protein group
 SELECT
-    grp_id,
-    A.exp_name AS exp_name,
-    CAST(A.ratio_type AS TEXT) AS ratio_type,
-    CAST((LOG(ratio_value, 2) - mean) / sd AS NUMERIC) AS z_score,
-    CAST(0.6745 * (LOG(ratio_value, 2) - median) / mad AS NUMERIC) AS m_score
+    B.grp_id AS grp_id,
+    IFNULL(GROUP_CONCAT(DISTINCT C.gene), '-') AS genes
 FROM
-    V_PGROUP_RATIO A, PGROUP_LOG2RATIO_STAT B
+    PROT2GRP B, V_PROTEIN C
 WHERE
-    A.exp_name = B.exp_name
-    AND A.ratio_type = B.ratio_type;
+    B.prot_acc = C.acc
+GROUP BY
+    B.grp_id;
+CREATE UNIQUE INDEX idx_GRP_GENES_grp_id ON GRP_GENES(grp_id);
+"""
+
+sql_create_indexes = """
 CREATE INDEX idx_PGROUP_MZSCORE_grp_id ON PGROUP_MZSCORE(grp_id);
 CREATE INDEX idx_PGROUP_MZSCORE_exp_name_ratio_type ON PGROUP_MZSCORE(exp_name, ratio_type);
-""" % (' '.join([ "\n\tWHEN quant_type='%s' THEN '%s'" % (k, v) for (k, v) in ratio_types.iteritems() ]),
-       "','".join(ratio_types.keys()))
+"""
+
+# lowest scores of the treatments (up- or down-regulated), also used as index expressions
+sql_min_up = 'MIN({dts}_L0_M0_H1_{score_type}_HL, {dts}_L0_M0_H1_{score_type}_HM, {dts}_L1_M1_H0_{score_type}_LH, {dts}_L1_M1_H0_{score_type}_MH)'
+sql_min_down = 'MIN({dts}_L0_M0_H1_{score_type}_LH, {dts}_L0_M0_H1_{score_type}_MH, {dts}_L1_M1_H0_{score_type}_HL, {dts}_L1_M1_H0_{score_type}_HM)'
 
 # dynamically construct SQL query to select diff. reg. protein groups
 sql_sel_pgrps = """
 SELECT
-    A.grp_id grp_id,
-    IFNULL(GROUP_CONCAT(DISTINCT gene), '-') genes,
+    CAST(A.grp_id AS TEXT) grp_id,
+    genes,
     {dts}_L0_M0_H1_{score_type}_HL '{stype}_H1L0', -- Z or M-score ON/OFF  (treat1)
     {dts}_L1_M1_H0_{score_type}_LH '{stype}_L1H0', -- Z or M-score ON/OFF  (treat2)
     {dts}_L0_M0_H1_{score_type}_HM '{stype}_H1M0', -- Z or M-score ON/OFF  (treat3)
     {dts}_L1_M1_H0_{score_type}_MH '{stype}_M1H0', -- Z or M-score ON/OFF  (treat4)
     {dts}_L0_M0_H1_{score_type}_LM '{stype}_L0M0', -- Z or M-score OFF/OFF (ctrl1)
-    {dts}_L1_M1_H0_{score_type}_LM '{stype}_L1M1', -- Z or M-score ON/ON   (ctrl2)
-    PVALUE({dts}_L0_M0_H1_{score_type}_HL) 'pval_H1L0', -- P-value ON/OFF  (treat1)
-    PVALUE({dts}_L1_M1_H0_{score_type}_LH) 'pval_L1H0', -- P-value ON/OFF  (treat2)
-    PVALUE({dts}_L0_M0_H1_{score_type}_HM) 'pval_H1M0', -- P-value ON/OFF  (treat3)
-    PVALUE({dts}_L1_M1_H0_{score_type}_MH) 'pval_M1H0', -- P-value ON/OFF  (treat4)
-    PVALUE({dts}_L0_M0_H1_{score_type}_LM) 'pval_L0M0', -- P-value OFF/OFF (ctrl1)
-    PVALUE({dts}_L1_M1_H0_{score_type}_LM) 'pval_L1M1'  -- P-value ON/ON   (ctrl2)
+    {dts}_L1_M1_H0_{score_type}_LM '{stype}_L1M1'  -- Z or M-score ON/ON   (ctrl2)
 FROM
-    V_PGROUP_MZSCORE A, PROT2GRP B, V_PROTEIN C
+    PGROUP_MZSCORE_PIVOT A, GRP_GENES G
 WHERE
-    A.grp_id = B.grp_id
-    AND B.prot_acc = C.acc
-    AND (({dts}_L0_M0_H1_{score_type}_HL > {cutoff}
-    AND {dts}_L0_M0_H1_{score_type}_HM > {cutoff}
-    AND {dts}_L1_M1_H0_{score_type}_LH > {cutoff}
-    AND {dts}_L1_M1_H0_{score_type}_MH > {cutoff})
-    OR ({dts}_L0_M0_H1_{score_type}_LH > {cutoff}
-    AND {dts}_L0_M0_H1_{score_type}_MH > {cutoff}
-    AND {dts}_L1_M1_H0_{score_type}_HL > {cutoff}
-    AND {dts}_L1_M1_H0_{score_type}_HM > {cutoff}))
-    AND {dts}_L0_M0_H1_{score_type}_ML <= {cutoff}
-    AND {dts}_L0_M0_H1_{score_type}_LM <= {cutoff}
-    AND {dts}_L1_M1_H0_{score_type}_ML <= {cutoff}
-    AND {dts}_L1_M1_H0_{score_type}_LM <= {cutoff}
-GROUP BY A.grp_id;
-""".format(dts=dts, score_type=score_type, stype=stype, cutoff=cutoff)
+    A.grp_id = G.grp_id
+    AND ({min_up} > :cutoff OR {min_down} > :cutoff)
+    AND {dts}_L0_M0_H1_{score_type}_ML <= :cutoff
+    AND {dts}_L0_M0_H1_{score_type}_LM <= :cutoff
+    AND {dts}_L1_M1_H0_{score_type}_ML <= :cutoff
+    AND {dts}_L1_M1_H0_{score_type}_LM <= :cutoff
+ORDER BY +A.grp_id; -- unary + favours the score indexes over the grp_id index
+""".format(dts=dts, score_type=score_type, stype=stype,
+           min_up=sql_min_up.format(dts=dts, score_type=score_type),
+           min_down=sql_min_down.format(dts=dts, score_type=score_type))
+
+# bind the cutoff to the named placeholders (:cutoff) so that the prepared statement is reused
+params = dict(cutoff=cutoff)
 
 # connect to db
-with sqlt.connect(args.dbfile) as conn:
-   conn.row_factory = sqlt.Row # enable column access by name: row['colnm']
-   conn.create_function('log', 2, log)
+with contextlib.closing(sqlt.connect(args.dbfile, cached_statements=256)) as conn:
+   conn.row_factory = sqlt.Row # rows indexed in C by position (row[0]) or name (row['colnm'])
+   conn.executescript(sql_pragmas)
+   try: # use the built-in log2() if SQLite is compiled with math functions
+      conn.execute('SELECT LOG2(1)')
+   except sqlt.OperationalError:
+      conn.create_function('log2', 1, log2, deterministic=True)
    conn.create_function('sqrt', 1, sqrt)
-   conn.create_function('pvalue', 1, pvalue)
    conn.create_aggregate('stdev', 1, Stdev)
    conn.create_aggregate('median', 1, Median)
    conn.create_aggregate('mad', 1, Mad)
    cur = conn.cursor()
 
    if new_tabs is True: # populate tables/views only with -n option
-      cur.executescript(sql_create_tables)
+      conn.executescript(sql_pragmas_write)
+
+      # populate all tables/views in a single transaction
+      cur.execute('BEGIN IMMEDIATE')
+      for stmt in sql_statements(sql_create_tables) + sql_statements(sql_create_grp_genes % ''):
+         cur.execute(stmt)
+
+      # compute (modified) Z-scores of log2 ratios in a single vectorized pass
+      cur.execute('SELECT exp_name, ratio_type, mean, sd, median, mad FROM PGROUP_LOG2RATIO_STAT')
+      stat_rows = cur.fetchall()
+      stat_idx = dict(((r[0], r[1]), i) for (i, r) in enumerate(stat_rows))
+      stats = np.array([ r[2:] for r in stat_rows ], dtype=np.float64).reshape(-1, 4)
+      cur.execute('SELECT grp_id, exp_name, ratio_type, ratio_value FROM V_PGROUP_RATIO')
+      rows = [ r for r in cur.fetchall() if (r[1], r[2]) in stat_idx ]
+      idx = np.array([ stat_idx[(r[1], r[2])] for r in rows ], dtype=np.intp)
+      mean, sd, median, mad = np.take(stats, idx, axis=0).T
+
+      with np.errstate(divide='ignore', invalid='ignore'):
+         l2 = np.log2(np.array([ r[3] for r in rows ], dtype=np.float64))
+         z_scores = (l2 - mean) / sd
+         m_scores = 0.6745 * (l2 - median) / mad
+
+      z_scores[~np.isfinite(z_scores)] = np.nan # stored as NULL
+      m_scores[~np.isfinite(m_scores)] = np.nan
+      cur.executemany('INSERT INTO PGROUP_MZSCORE VALUES(?,?,?,?,?)',
+                      zip([ r[0] for r in rows ], [ r[1] for r in rows ], [ r[2] for r in rows ],
+                          z_scores.tolist(), m_scores.tolist()))
+      for stmt in sql_statements(sql_create_indexes):
+         cur.execute(stmt)
+
       cur.execute('SELECT DISTINCT exp_name FROM EXPERIMENT')
       exp_names = [ str(r[0]) for r in cur.fetchall() ]
-      cur.execute("SELECT DISTINCT ratio_type FROM PGROUP_LOG2RATIO_STAT")
-      ratio_types = [ str(r[0]) for r in cur.fetchall() ]
-      n = len(exp_names) * len(ratio_types)
+      ratio_cols = sorted(ratio_types.values()) # ratio types are known upfront
+      n = len(exp_names) * len(ratio_cols)
       i = 0
       comma = ','
 
-      # create view for selecting diff. reg. proteins
-      sql_create_view = """
+      # materialize (pivot) the scores per protein group for selecting diff. reg. proteins
+      sql_create_pivot = """
 DROP VIEW IF EXISTS V_PGROUP_MZSCORE;
-CREATE VIEW V_PGROUP_MZSCORE AS
+DROP TABLE IF EXISTS PGROUP_MZSCORE_PIVOT;
+CREATE TABLE PGROUP_MZSCORE_PIVOT AS
 SELECT
     grp_id,
 """
       for e in exp_names:
-         for r in ratio_types:
+         for r in ratio_cols:
             i += 1
             rr = r[:-2] + r[-2:][::-1] # add inverse ratio (e.g., {raw|norm}_ratio_HL for *_ratio_LH)
             if i == n: comma = ''
-            sql_create_view += "\tROUND(CAST(GROUP_CONCAT(CASE WHEN exp_name = '{exp}' AND ratio_type = '{ratio}' THEN z_score ELSE NULL END) AS NUMERIC), 4) AS '{exp}_z_score_{ratio}',\n".format(exp=e, ratio=r)
-            sql_create_view += "\tROUND(CAST(GROUP_CONCAT(CASE WHEN exp_name = '{exp}' AND ratio_type = '{ratio}' THEN -1 * z_score ELSE NULL END) AS NUMERIC), 4) AS '{exp}_z_score_{iratio}',\n".format(exp=e, ratio=r, iratio=rr)
-            sql_create_view += "\tROUND(CAST(GROUP_CONCAT(CASE WHEN exp_name = '{exp}' AND ratio_type = '{ratio}' THEN m_score ELSE NULL END) AS NUMERIC), 4) AS '{exp}_m_score_{ratio}',\n".format(exp=e, ratio=r)
-            sql_create_view += "\tROUND(CAST(GROUP_CONCAT(CASE WHEN exp_name = '{exp}' AND ratio_type = '{ratio}' THEN -1 * m_score ELSE NULL END) AS NUMERIC), 4) AS '{exp}_m_score_{iratio}'{comma}\n".format(exp=e, ratio=r, iratio=rr, comma=comma)
-      sql_create_view += "FROM PGROUP_MZSCORE GROUP BY grp_id"
-      cur.executescript(sql_create_view)
+            sql_create_pivot += "\tROUND(MAX(CASE WHEN exp_name = '{exp}' AND ratio_type = '{ratio}' THEN z_score ELSE NULL END), 4) AS '{exp}_z_score_{ratio}',\n".format(exp=e, ratio=r)
+            sql_create_pivot += "\tROUND(MAX(CASE WHEN exp_name = '{exp}' AND ratio_type = '{ratio}' THEN -1 * z_score ELSE NULL END), 4) AS '{exp}_z_score_{iratio}',\n".format(exp=e, ratio=r, iratio=rr)
+            sql_create_pivot += "\tROUND(MAX(CASE WHEN exp_name = '{exp}' AND ratio_type = '{ratio}' THEN m_score ELSE NULL END), 4) AS '{exp}_m_score_{ratio}',\n".format(exp=e, ratio=r)
+            sql_create_pivot += "\tROUND(MAX(CASE WHEN exp_name = '{exp}' AND ratio_type = '{ratio}' THEN -1 * m_score ELSE NULL END), 4) AS '{exp}_m_score_{iratio}'{comma}\n".format(exp=e, ratio=r, iratio=rr, comma=comma)
+      sql_create_pivot += """FROM PGROUP_MZSCORE GROUP BY grp_id;
+CREATE UNIQUE INDEX idx_PGROUP_MZSCORE_PIVOT_grp_id ON PGROUP_MZSCORE_PIVOT(grp_id);
+CREATE VIEW V_PGROUP_MZSCORE AS SELECT * FROM PGROUP_MZSCORE_PIVOT;
+"""
+      # index the lowest treatment scores per data set to skip groups below the cutoff
+      for d in sorted(set([ e.split('_')[0] for e in exp_names ])):
+         if d + '_L0_M0_H1' not in exp_names or d + '_L1_M1_H0' not in exp_names:
+            continue
+         for s in sorted(score_types.values()):
+            for (updown, expr) in (('up', sql_min_up), ('down', sql_min_down)):
+               sql_create_pivot += "CREATE INDEX idx_PGROUP_MZSCORE_PIVOT_{dts}_{score_type}_{updown} ON PGROUP_MZSCORE_PIVOT({expr});\n".format(
+                  dts=d, score_type=s, updown=updown, expr=expr.format(dts=d, score_type=s))
+      for stmt in sql_statements(sql_create_pivot):
+         cur.execute(stmt)
+      conn.commit()
    
    # write results onto tab-delim file
    if dts is not None:
-      sep = '\t' # column separator
       n_pgrps = 0 # count diff. reg. protein groups
-      with open(outfile, 'w+') as fout:
+      with io.open(outfile, 'w', buffering=1 << 20, newline='') as fout: # 1MB write buffer
+         writer = csv.writer(fout, delimiter='\t', lineterminator=os.linesep)
+         hint = '' # appended to the error message
          try:
-            for drow in [ cls.OrderedDict(xi) for xi in cur.execute(sql_sel_pgrps) ]:
+            # fall back on the view/gene names of a db scored by an older version (before the pivot table)
+            cur.execute("SELECT name FROM sqlite_master WHERE name IN ('PGROUP_MZSCORE_PIVOT', 'V_PGROUP_MZSCORE', 'GRP_GENES')")
+            tabs = [ r[0] for r in cur.fetchall() ]
+            if 'PGROUP_MZSCORE_PIVOT' not in tabs and 'V_PGROUP_MZSCORE' not in tabs: # db not scored yet
+               hint = ' (re-run with -n to compute the scores)'
+            if 'GRP_GENES' not in tabs:
+               for stmt in sql_statements(sql_create_grp_genes % 'TEMP'):
+                  cur.execute(stmt)
+            if 'PGROUP_MZSCORE_PIVOT' not in tabs:
+               sql_sel_pgrps = sql_sel_pgrps.replace('PGROUP_MZSCORE_PIVOT', 'V_PGROUP_MZSCORE')
+
+            cur.arraysize = 10000 # number of rows per fetchmany()
+            cur.execute(sql_sel_pgrps, params)
+            cols = [ d[0] for d in cur.description ]
+            cols += [ 'pval_' + c.split('_')[-1] for c in cols[2:] ] # P-value per Z- or M-score
+
+            while True:
+               rows = cur.fetchmany()
+               if not rows:
+                  break
+
                # first output column names
                if n_pgrps == 0:
-                  header = sep.join(drow.keys()) + os.linesep
-                  fout.write(header)
+                  writer.writerow(cols)
+
+               # convert Z- or M-scores to two-tailed probabilities (P-values) batch-wise
+               scores = np.array([ row[2:] for row in rows ], dtype=np.float64) # NULL as NaN
+               vals = np.hstack((scores, 2 * st.norm.cdf(-np.abs(scores))))
+               svals = np.char.mod('%.4f', vals)
+               svals[np.isnan(vals)] = 'NA'
 
                # output remaining rows with column values (grp_id, Z-/M-scores and P-values)
-               row = drow.values()
-               grp_id = str(drow['grp_id'])
-               genes = str(drow['genes'])
-               scores = [ str(round(float(x), 4)) for x in row[2:] ]
-               srow = grp_id + sep + genes + sep + sep.join(scores) + os.linesep
-               fout.write(srow)
-               n_pgrps += 1
+               writer.writerows([ row[:2] + tuple(v) for (row, v) in zip(rows, svals.tolist()) ])
+               n_pgrps += len(rows)
 
          except sqlt.OperationalError as e:
-            sys.stderr.write('Error: Selected data set not found: %s\n' % e)
+            sys.stderr.write('Error: Selected data set not found: %s%s\n' % (e, hint))
+            fout.close()
+            os.remove(outfile)
             sys.exit(1)
 
       # remove empty outfile
       if os.path.getsize(outfile) == 0:
-         print 'Nothing to write onto outfile.'
+         print('Nothing to write onto outfile.')
          os.remove(outfile)
       else:
-         print 'Ndiff =', n_pgrps
+         print('Ndiff =', n_pgrps)
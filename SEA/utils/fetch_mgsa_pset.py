@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #
 # This script fetches a population set of protein accessions from an SQLite database and
 # writes the result set into an output file used for MGSA analysis (Bauer et al., 2010).
@@ -11,7 +11,10 @@
 import os
 import sys
 import argparse as argp
+import csv
+import io
 import sqlite3 as sqlt
+import pathlib
 
 def main():
    parser = argp.ArgumentParser(
@@ -47,9 +50,9 @@ def main():
    # N.B.: Only a leading protein (accession) per group is selected.
    sql_query = """
 SELECT
-   DISTINCT(prot_acc) AS prot_acc
+   prot_acc
 FROM
-   VVV_PGROUP_QUANT INNER JOIN PROT2GRP USING(grp_id) INNER JOIN PEP2PROT USING(prot_acc)
+   VVV_PGROUP_QUANT INNER JOIN PROT2GRP USING(grp_id)
 WHERE
    {exp1}_{HL} AND
    {exp1}_{HM} AND
@@ -57,20 +60,39 @@ WHERE
    {exp2}_{HL} AND
    {exp2}_{HM} AND
    {exp2}_{ML} AND
-   lead_prot != 0;
+   lead_prot != 0
+GROUP BY
+   prot_acc;
    """.format(exp1 = dts + '_L0_M0_H1',
               exp2 = dts + '_L1_M1_H0',
               HL   = 'norm_ratio_HL',
               HM   = 'norm_ratio_HM',
               ML   = 'norm_ratio_ML')
 
-   # connect to db and write result set onto file
-   with open(outfile, 'w') as fout:
-      with sqlt.connect(dbfile) as conn:
+   # SQL statements to tune the (read-only) connection: 256MB page cache, in-memory temp tables
+   sql_pragmas = """
+      PRAGMA cache_size = -262144;
+      PRAGMA temp_store = MEMORY;
+      PRAGMA mmap_size = 268435456;
+   """
+
+   # connect to db (read-only) and write result set onto file
+   dburi = pathlib.Path(dbfile).resolve().as_uri() + '?mode=ro' # honours a -wal file left by a writer
+   with io.open(outfile, 'w', buffering = 1 << 16, newline = '') as fout: # 64KB write buffer
+      with sqlt.connect(dburi, uri = True) as conn:
+         writer = csv.writer(fout, lineterminator = os.linesep)
+         conn.executescript(sql_pragmas) # large page cache, in-memory temp tables
          try:
             cur = conn.cursor()
-            for row in cur.execute(sql_query):
-               fout.write(str(row[0]) + os.linesep)
+            cur.execute('PRAGMA query_only = 1')
+
+            cur.arraysize = 50000 # number of rows per fetchmany()
+            cur.execute(sql_query)
+            while True:
+               rows = cur.fetchmany()
+               if not rows:
+                  break
+               writer.writerows(rows)
             cur.close()
 
          except sqlt.OperationalError as err: